@@ -72,7 +72,16 @@ class AssetScenario(object):
 
         # Calculate a default rate process for all periods
         dr = np.random.normal(self.mean_default_rate, self.std_default_rate, self.periods)
-        self.conditional_default_rate = np.around(np.clip(dr, a_min=0.0, a_max=None), decimals=3)
+        self.project(np.around(np.clip(dr, a_min=0.0, a_max=None), decimals=3))
+
+    def project(self, default_rate):
+        """
+        Calculate the portfolio notional, principal and interest proceeds implied by a given
+        default rate process (one rate per period)
+
+        """
+
+        self.conditional_default_rate = np.asarray(default_rate, dtype=float)
 
         # Initialize the outstanding notional
         self.notional[0] = self.initial_notional
@@ -107,3 +116,141 @@ class AssetScenario(object):
         # Pickle the object using the highest protocol available.
         pickle.dump(self, output, -1)
         output.close()
+
+
+class AssetScenarioSet(object):
+    def __init__(self, n_scenarios=1, n=10, dtype=np.float64):
+        """ The AssetScenarioSet object holds the asset cashflow streams of a collection of scenarios
+        (one row per scenario) so that a waterfall can be evaluated for all of them at once.
+        The dtype (float64 or float32) is also the default dtype of the waterfall result cubes.
+
+        """
+
+        # The number of scenarios
+        self.scenarios = n_scenarios
+        # The number of periods to calculate
+        self.periods = n
+        # The risk free rate (per scenario)
+        self.r = np.zeros(n_scenarios, dtype=dtype)
+        # The initial notional value of the portfolio (per scenario)
+        self.initial_notional = np.ones(n_scenarios, dtype=dtype)
+        # Principal proceeds process
+        self.principal_proceeds = np.zeros((n_scenarios, n), dtype=dtype)
+        # Interest proceeds process
+        self.interest_proceeds = np.zeros((n_scenarios, n), dtype=dtype)
+        # Portfolio notional process
+        self.notional = np.zeros((n_scenarios, n), dtype=dtype)
+
+    @classmethod
+    def from_scenarios(cls, scenarios, dtype=np.float64):
+        """
+        Stack a list of AssetScenario objects with a common number of periods, stored with the given dtype
+
+        """
+
+        n = scenarios[0].periods
+        out = cls(len(scenarios), n, dtype=dtype)
+        for s, A in enumerate(scenarios):
+            if A.periods != n:
+                raise ValueError('All scenarios must have the same number of periods')
+            out.r[s] = A.r
+            out.initial_notional[s] = A.initial_notional
+            out.principal_proceeds[s] = A.principal_proceeds
+            out.interest_proceeds[s] = A.interest_proceeds
+            out.notional[s] = A.notional
+        return out
+
+    @classmethod
+    def from_default_rates(cls, default_rate, r=0.0, asset_spread=0.1, recovery=0.30, initial_notional=1.0,
+                           dtype=np.float64):
+        """
+        Calculate the portfolio cashflows implied by a matrix of default rate processes (one row per
+        scenario), with the same projection as AssetScenario.project. The projection is carried out in
+        float64 and the result stored with the given dtype
+
+        """
+
+        default_rate = np.atleast_2d(np.asarray(default_rate, dtype=float))
+        n_scenarios, n = default_rate.shape
+        out = cls(n_scenarios, n)
+        out.r[:] = r
+        out.initial_notional[:] = initial_notional
+
+        for k in range(n):
+            if k == 0:
+                out.notional[:, k] = (1.0 - default_rate[:, k]) * out.initial_notional
+            else:
+                out.notional[:, k] = (1.0 - default_rate[:, k]) * out.notional[:, k - 1]
+            out.principal_proceeds[:, k] = default_rate[:, k] * recovery * \
+                (out.initial_notional if k == 0 else out.notional[:, k])
+
+        # Interest Proceeds are from outstanding notional at end of period
+        out.interest_proceeds = (out.r + asset_spread)[:, None] * out.notional
+
+        # End of Final period cashflows (repayment)
+        out.principal_proceeds[:, n - 1] = out.notional[:, n - 1]
+        out.notional[:, n - 1] = 0.0
+
+        out.notional = np.around(out.notional, decimals=3)
+        out.principal_proceeds = np.around(out.principal_proceeds, decimals=3)
+        out.interest_proceeds = np.around(out.interest_proceeds, decimals=3)
+        return out.astype(dtype)
+
+    def astype(self, dtype):
+        """
+        Return a copy of the scenario set stored with another float dtype
+
+        """
+
+        out = AssetScenarioSet.__new__(AssetScenarioSet)
+        out.scenarios = self.scenarios
+        out.periods = self.periods
+        for field in ['r', 'initial_notional', 'principal_proceeds', 'interest_proceeds', 'notional']:
+            setattr(out, field, getattr(self, field).astype(dtype))
+        return out
+
+    @classmethod
+    def concatenate(cls, sets):
+        """
+        Stack several AssetScenarioSet objects with a common number of periods
+
+        """
+
+        out = cls.__new__(cls)
+        out.periods = sets[0].periods
+        if any(X.periods != out.periods for X in sets):
+            raise ValueError('All scenarios must have the same number of periods')
+        for field in ['r', 'initial_notional', 'principal_proceeds', 'interest_proceeds', 'notional']:
+            setattr(out, field, np.concatenate([getattr(X, field) for X in sets]))
+        out.scenarios = len(out.r)
+        return out
+
+    def chunk(self, start, stop):
+        """
+        Extract the scenarios start..stop-1 as an AssetScenarioSet (sharing the data of this set)
+
+        """
+
+        out = AssetScenarioSet.__new__(AssetScenarioSet)
+        out.periods = self.periods
+        out.r = self.r[start:stop]
+        out.initial_notional = self.initial_notional[start:stop]
+        out.principal_proceeds = self.principal_proceeds[start:stop]
+        out.interest_proceeds = self.interest_proceeds[start:stop]
+        out.notional = self.notional[start:stop]
+        out.scenarios = len(out.r)
+        return out
+
+    def scenario(self, s):
+        """
+        Extract the s-th scenario as an AssetScenario object
+
+        """
+
+        A = AssetScenario(self.periods)
+        A.r = float(self.r[s])
+        A.initial_notional = float(self.initial_notional[s])
+        A.principal_proceeds = self.principal_proceeds[s].copy()
+        A.interest_proceeds = self.interest_proceeds[s].copy()
+        A.notional = self.notional[s].copy()
+        return A
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+# (c) 2019 - 2024 Open Risk, all rights reserved
+#
+# openSecuritisation is licensed under the Apache 2.0 license a copy of which is included
+# in the source distribution of TransitionMatrix. This is notwithstanding any licenses of
+# third-party software included in this distribution. You may not use this file except in
+# compliance with the License.
+#
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" This module provides quantile fan charts of waterfall results over large scenario sets
+
+* quantile_bands_ calculates per-period quantiles of a result cube (exactly, or with a streaming sketch)
+* QuantileSketch_ is a mergeable fixed-bin histogram sketch for scenario sets that do not fit in memory
+* render_fan_charts_ draws the per-tranche payment, notional and equity fan charts
+
+Only the quantile bands are passed to the plotting layer, so that the rendering time does not depend
+on the number of scenarios. Plotting requires matplotlib (optional dependency).
+
+"""
+
+import numpy as np
+
+DEFAULT_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+
+class QuantileSketch(object):
+    def __init__(self, lower, upper, bins=512):
+        """ The QuantileSketch object keeps one histogram with a fixed number of bins per element (e.g. per
+        tranche and period) between the given lower and upper bounds (arrays of the element shape).
+        Quantiles are interpolated within bins, so their error is at most (upper - lower) / bins.
+
+        """
+
+        self.lower = np.asarray(lower, dtype=np.float64)
+        self.upper = np.asarray(upper, dtype=np.float64)
+        self.bins = bins
+        self.count = 0
+        # Bin 0 and bin bins + 1 collect values below / above the bounds
+        self.counts = np.zeros(self.lower.shape + (bins + 2,), dtype=np.int64)
+
+    def update(self, chunk):
+        """
+        Add a chunk of scenarios (scenario axis first) to the histograms, in one vectorized pass
+
+        """
+
+        chunk = np.asarray(chunk, dtype=np.float64)
+        width = np.where(self.upper > self.lower, self.upper - self.lower, 1.0)
+        index = np.floor((chunk - self.lower) / width * self.bins).astype(np.int64) + 1
+        index = np.clip(index, 0, self.bins + 1)
+        # Offset the bin index of each element so that a single bincount fills all histograms
+        offset = np.arange(self.lower.size, dtype=np.int64).reshape(self.lower.shape) * (self.bins + 2)
+        counts = np.bincount((index + offset).ravel(), minlength=self.counts.size)
+        self.counts += counts.reshape(self.counts.shape)
+        self.count += len(chunk)
+
+    def merge(self, other):
+        """
+        Add the histograms of another sketch with the same bounds and bins (e.g. of another worker)
+
+        """
+
+        if other.bins != self.bins or not (np.array_equal(other.lower, self.lower) and
+                                           np.array_equal(other.upper, self.upper)):
+            raise ValueError('Only sketches with the same bounds and number of bins can be merged')
+        self.counts += other.counts
+        self.count += other.count
+
+    def quantiles(self, q=DEFAULT_QUANTILES):
+        """
+        Return the quantiles as an array of shape (len(q),) + element shape
+
+        """
+
+        cumulative = np.cumsum(self.counts, axis=-1)
+        out = np.zeros((len(q),) + self.lower.shape)
+        width = (self.upper - self.lower) / self.bins
+        for i, p in enumerate(q):
+            rank = p * self.count
+            # First bin whose cumulative count reaches the rank, interpolated linearly within the bin
+            b = np.minimum((cumulative < rank).sum(axis=-1), self.bins + 1)
+            below = np.take_along_axis(cumulative, np.maximum(b - 1, 0)[..., None], axis=-1)[..., 0]
+            below = np.where(b > 0, below, 0)
+            inside = np.take_along_axis(self.counts, b[..., None], axis=-1)[..., 0]
+            fraction = np.where(inside > 0, (rank - below) / np.maximum(inside, 1), 0.0)
+            out[i] = self.lower + (np.clip(b - 1, 0, self.bins - 1) + np.clip(fraction, 0.0, 1.0)) * width
+            out[i] = np.where(b == 0, self.lower, np.where(b == self.bins + 1, self.upper, out[i]))
+        return out
+
+
+def quantile_bands(cube, q=DEFAULT_QUANTILES, max_bytes=1 << 26, bins=512, lower=None, upper=None):
+    """
+    Calculate the quantiles over the scenario axis (axis 0) of a result cube, e.g. of shape
+    (scenarios, bonds, periods), returning an array of shape (len(q), bonds, periods).
+
+    Cubes up to max_bytes are processed exactly in one vectorized pass. Larger cubes (e.g. memory-mapped
+    results from the ResultCache) are streamed into a QuantileSketch in scenario chunks of at most max_bytes
+    (in float64), which keeps the memory use independent of the number of scenarios. The histogram bounds
+    are found in a first pass over the cube unless given (lower and upper, scalars or arrays of the element
+    shape), in which case the cube is read once and quantiles outside the bounds are clipped to them.
+
+    """
+
+    if cube.nbytes <= max_bytes:
+        return np.quantile(np.asarray(cube), q, axis=0)
+
+    n = cube.shape[0]
+    chunk_size = max(1, max_bytes // (int(np.prod(cube.shape[1:])) * 8))
+    if lower is None or upper is None:
+        lower = np.full(cube.shape[1:], np.inf)
+        upper = np.full(cube.shape[1:], -np.inf)
+        for start in range(0, n, chunk_size):
+            chunk = cube[start:start + chunk_size]
+            lower = np.minimum(lower, chunk.min(axis=0))
+            upper = np.maximum(upper, chunk.max(axis=0))
+    else:
+        lower = np.broadcast_to(np.asarray(lower, dtype=np.float64), cube.shape[1:])
+        upper = np.broadcast_to(np.asarray(upper, dtype=np.float64), cube.shape[1:])
+    sketch = QuantileSketch(lower, upper, bins)
+    for start in range(0, n, chunk_size):
+        sketch.update(cube[start:start + chunk_size])
+    return sketch.quantiles(q)
+
+
+def render_fan(ax, bands, q=DEFAULT_QUANTILES, color='tab:blue', label=None):
+    """
+    Draw one fan chart from quantile bands of shape (len(q), periods): shaded areas between symmetric
+    quantile pairs and a line for the median (if included)
+
+    """
+
+    periods = np.arange(bands.shape[-1])
+    pairs = len(q) // 2
+    for i in range(pairs):
+        ax.fill_between(periods, bands[i], bands[len(q) - 1 - i], color=color, alpha=0.15 + 0.5 * i / max(pairs, 1),
+                        linewidth=0, label=str(q[i]) + ' - ' + str(q[len(q) - 1 - i]))
+    if len(q) % 2:
+        ax.plot(periods, bands[pairs], color=color, linewidth=1.0, label=label or 'median')
+
+
+def render_fan_charts(R, filename, S=None, q=DEFAULT_QUANTILES, bounds=None, **kwargs):
+    """
+    Render the per-tranche payment and notional fan charts and the equity fan chart of a WaterfallResult
+    to a PNG or SVG file (by file extension). Bond indicators are taken from the structure S if given.
+    Known value ranges can be given as bounds, a dictionary from field ('payment', 'notional', 'equity')
+    to (lower, upper), to avoid the bounds pass over large cubes. Additional arguments are passed to
+    quantile_bands.
+
+    """
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    bands = {}
+    for field in ['payment', 'notional', 'equity']:
+        lower, upper = (bounds or {}).get(field, (None, None))
+        bands[field] = quantile_bands(getattr(R, field), q, lower=lower, upper=upper, **kwargs)
+    payment, notional, equity = bands['payment'], bands['notional'], bands['equity']
+
+    M = payment.shape[1]
+    names = [B.Indicator for B in S.Liabilities] if S is not None else ['Bond ' + str(j) for j in range(M)]
+    fig, axes = plt.subplots(M + 1, 2, figsize=(10, 2.5 * (M + 1)), sharex=True, squeeze=False)
+    for j in range(M):
+        render_fan(axes[j, 0], payment[:, j], q)
+        axes[j, 0].set_title(names[j] + ' Payment')
+        render_fan(axes[j, 1], notional[:, j], q, color='tab:orange')
+        axes[j, 1].set_title(names[j] + ' Notional')
+    render_fan(axes[M, 0], equity, q, color='tab:green')
+    axes[M, 0].set_title('Equity Payment')
+    axes[M, 1].axis('off')
+    axes[0, 0].legend(fontsize='small')
+    for ax in axes[M]:
+        ax.set_xlabel('Period')
+    fig.tight_layout()
+    fig.savefig(filename)
+    plt.close(fig)
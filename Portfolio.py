@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+# (c) 2019 - 2024 Open Risk, all rights reserved
+#
+# openSecuritisation is licensed under the Apache 2.0 license a copy of which is included
+# in the source distribution of TransitionMatrix. This is notwithstanding any licenses of
+# third-party software included in this distribution. You may not use this file except in
+# compliance with the License.
+#
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" This module provides a runner for portfolios of securitisation positions
+
+* Deal_ holds a structure, its asset scenario stream and the positions held in its tranches
+* run_portfolio_ evaluates all deals under a shared scenario set on a worker pool
+* PortfolioResult_ holds the aggregated portfolio cashflows and loss distribution
+
+The scenario sets of all deals are aligned: row s of every deal's AssetScenarioSet is driven by the
+same macro (default and rate) scenario s.
+
+The bonds outstanding before maturity are repaid from the final period cash (sold collateral and reserve
+account) as calculated by Waterfall.maturity_repayment, which defines both the final period bond cashflows and
+the losses: the principal written down on the positions held.
+
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from Waterfall import check_lambdas, load_lambdas, load_structure, maturity_repayment, run_waterfall_batch
+
+
+class Deal(object):
+    def __init__(self, name, structure_file, scenarios, positions, lambdas_file='lambda_dictionary.yml'):
+        """ The Deal object combines a securitisation structure (loaded once), the AssetScenarioSet of its
+        collateral pool and the positions held, as a dictionary from bond Indicator to the share of the
+        tranche that is held. The lambda dictionary is validated here and loaded again by each worker
+        (lambda functions cannot be pickled).
+
+        """
+
+        self.name = name
+        self.structure = load_structure(structure_file)
+        self.lambdas_file = lambdas_file
+        check_lambdas(load_lambdas(lambdas_file)[0])
+        self.scenarios = scenarios
+        self.positions = positions
+        unknown = set(positions) - set(B.Indicator for B in self.structure.Liabilities)
+        if unknown:
+            raise ValueError('Deal ' + name + ' has no tranches ' + ', '.join(sorted(unknown)))
+
+    def weights(self):
+        """ The share held of each bond of the structure (zero if not held) """
+        return np.array([self.positions.get(B.Indicator, 0.0) for B in self.structure.Liabilities])
+
+    def face(self):
+        """ The initial notional held across all tranches """
+        return float(np.dot(self.weights(), [B.initial_Notional for B in self.structure.Liabilities]))
+
+    def cost(self):
+        """ Relative cost of evaluating one scenario (tranche and test count times horizon) """
+        return self.scenarios.periods * (len(self.structure.Liabilities) + self.structure.Tests)
+
+
+class PortfolioResult(object):
+    def __init__(self, n_scenarios, N):
+        """ The PortfolioResult object holds the position-weighted bond cashflows and principal
+        writedowns aggregated over all deals (one row per scenario) and the face amount held.
+
+        """
+
+        self.cashflows = np.zeros((n_scenarios, N))
+        self.writedown = np.zeros(n_scenarios)
+        self.face = 0.0
+
+    def loss(self):
+        """ Loss per scenario: the principal written down on the positions held (never negative) """
+        return self.writedown
+
+    def loss_rate(self):
+        """ Loss per scenario as a fraction of the face amount held """
+        return self.writedown / self.face if self.face > 0 else np.zeros(len(self.writedown))
+
+    def loss_quantiles(self, q=(0.5, 0.9, 0.99, 0.999)):
+        return np.quantile(self.loss(), q)
+
+    def loss_distribution(self, bins=50):
+        """ Histogram (counts, bin edges) of the portfolio loss over the scenarios """
+        return np.histogram(self.loss(), bins=bins)
+
+
+def position_cashflows(S, X, F, weights):
+    """
+    Run the waterfall of a structure for an AssetScenarioSet X and return the position-weighted bond
+    cashflows (scenarios, periods), with the final period replaced by the maturity repayment, and the
+    position-weighted principal writedowns (scenarios)
+
+    """
+
+    R = run_waterfall_batch(S, X, F)
+    payment, writedown = maturity_repayment(S, R, X.r)
+    cashflows = np.einsum('smn,m->sn', R.payment, weights)
+    cashflows[:, -1] = payment @ weights
+    return cashflows, writedown @ weights
+
+
+###################################################
+# Worker side
+#
+# The structures, positions and lambda files are sent to each worker once (pool initializer),
+# tasks carry the scenario chunk they evaluate
+###################################################
+
+_DEALS = None
+_LAMBDAS = None
+
+
+def _init_worker(deals):
+    global _DEALS, _LAMBDAS
+    _DEALS = deals
+    _LAMBDAS = {}
+    for structure, lambdas_file, weights in deals:
+        if lambdas_file not in _LAMBDAS:
+            _LAMBDAS[lambdas_file] = load_lambdas(lambdas_file)[0]
+
+
+def _run_task(d, start, stop, X):
+    structure, lambdas_file, weights = _DEALS[d]
+    # Reduce to the position-weighted cashflows and writedowns before returning to the parent process
+    return (d, start, stop) + position_cashflows(structure, X, _LAMBDAS[lambdas_file], weights)
+
+
+def schedule(deals, workers, chunk_size=None):
+    """
+    Split all deals into (deal, scenario chunk) tasks of roughly equal cost, most expensive first.
+    The chunk_size is the number of scenarios per task for a deal of average cost
+
+    """
+
+    n_scenarios = deals[0].scenarios.scenarios
+    if chunk_size is None:
+        # About four tasks per worker
+        chunk_size = n_scenarios * len(deals) / (4 * max(workers, 1))
+
+    # Chunks of expensive deals (more tranches / tests, longer horizon) hold proportionally fewer scenarios
+    mean_cost = np.mean([deal.cost() for deal in deals])
+    tasks = []
+    for d, deal in enumerate(deals):
+        size = max(1, int(round(chunk_size * mean_cost / deal.cost())))
+        for start in range(0, n_scenarios, size):
+            stop = min(start + size, n_scenarios)
+            tasks.append(((stop - start) * deal.cost(), d, start, stop))
+    tasks.sort(reverse=True)
+    return [(d, start, stop) for _, d, start, stop in tasks]
+
+
+def run_portfolio(deals, workers=None, chunk_size=None):
+    """
+    Evaluate all deals under the shared scenario set and aggregate the position-weighted tranche
+    cashflows and writedowns into a PortfolioResult, as the tasks complete. With workers=0 the tasks run in process.
+
+    """
+
+    n_scenarios = deals[0].scenarios.scenarios
+    for deal in deals:
+        if deal.scenarios.scenarios != n_scenarios:
+            raise ValueError('All deals must share the same number of scenarios')
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    P = PortfolioResult(n_scenarios, max(deal.scenarios.periods for deal in deals))
+    P.face = sum(deal.face() for deal in deals)
+    tasks = schedule(deals, workers, chunk_size)
+
+    def add(d, start, stop, cashflows, losses):
+        P.cashflows[start:stop, :cashflows.shape[1]] += cashflows
+        P.writedown[start:stop] += losses
+
+    # Only the scenario chunk of each task is sent with it, so that workers do not hold all scenario data
+    specifications = [(deal.structure, deal.lambdas_file, deal.weights()) for deal in deals]
+    tasks = [(d, start, stop, deals[d].scenarios.chunk(start, stop)) for d, start, stop in tasks]
+    if workers == 0:
+        _init_worker(specifications)
+        for task in tasks:
+            add(*_run_task(*task))
+        return P
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(specifications,)) as pool:
+        futures = [pool.submit(_run_task, *task) for task in tasks]
+        for future in as_completed(futures):
+            add(*future.result())
+    return P
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+# (c) 2019 - 2024 Open Risk, all rights reserved
+#
+# openSecuritisation is licensed under the Apache 2.0 license a copy of which is included
+# in the source distribution of TransitionMatrix. This is notwithstanding any licenses of
+# third-party software included in this distribution. You may not use this file except in
+# compliance with the License.
+#
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" This module provides a content-addressed cache of waterfall results
+
+* ResultCache_ stores named arrays (result cubes or aggregated statistics) on local disk
+
+Entries are keyed by hashes of the structure file, the lambda dictionary, the scenario data and the
+engine source code, so that a change to any of the inputs or to the engine produces a new key and stale
+entries are never served. The cache size is bounded with least recently used eviction.
+
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from Waterfall import WaterfallResult, check_lambdas, load_lambdas, load_structure, run_waterfall_batch
+
+# Source files whose content defines the engine version
+ENGINE_FILES = ['Waterfall.py', 'Securitisation.py']
+
+
+def hash_file(filename):
+    """
+    Calculate the SHA-256 digest of the content of a file
+
+    """
+
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_scenarios(X):
+    """
+    Calculate the SHA-256 digest of the data of an AssetScenarioSet
+
+    """
+
+    h = hashlib.sha256()
+    for array in [X.r, X.initial_notional, X.principal_proceeds, X.interest_proceeds, X.notional]:
+        array = np.ascontiguousarray(array)
+        h.update(str((array.dtype.str, array.shape)).encode())
+        h.update(array.tobytes())
+    return h.hexdigest()
+
+
+def engine_version():
+    """
+    Calculate the digest of the engine source code
+
+    """
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    h = hashlib.sha256()
+    for filename in ENGINE_FILES:
+        h.update(hash_file(os.path.join(directory, filename)).encode())
+    return h.hexdigest()
+
+
+class ResultCache(object):
+    def __init__(self, directory='.result_cache', max_bytes=1 << 30):
+        """ The ResultCache object stores named numpy arrays under a content key, one directory per entry
+        and one .npy file per array. Cache hits are served as read-only memory-mapped arrays.
+
+        """
+
+        # Location of the cache on local disk
+        self.directory = directory
+        # Maximum total size of all entries (bytes)
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(structure_file, lambdas_file, X, kind='result'):
+        """
+        Calculate the cache key of a (structure, lambdas, scenario) run. The kind distinguishes
+        different outputs of the same run (e.g. full result cubes and aggregated statistics)
+
+        """
+
+        h = hashlib.sha256()
+        for part in [hash_file(structure_file), hash_file(lambdas_file), hash_scenarios(X), engine_version(), kind]:
+            h.update(part.encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key, names=None):
+        """
+        Return a dictionary of memory-mapped arrays for a key, or None if the key is not cached. If the
+        names of the expected arrays are given, an entry missing any of them is also a miss
+
+        An entry may be evicted by another process while it is read: a missing or partially removed
+        entry is treated as a miss.
+
+        """
+
+        path = self._path(key)
+        try:
+            arrays = {}
+            for filename in os.listdir(path):
+                if filename.endswith('.npy'):
+                    arrays[filename[:-4]] = np.load(os.path.join(path, filename), mmap_mode='r')
+            # Mark the entry as most recently used
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        if not arrays or (names is not None and not set(names) <= set(arrays)):
+            return None
+        return arrays
+
+    def put(self, key, arrays):
+        """
+        Store a dictionary of named arrays under a key, evicting least recently used entries to make room.
+        Returns False (and stores nothing) if the arrays alone exceed the cache bound. An existing entry
+        missing any of the arrays (partially removed by a concurrent eviction) is replaced
+
+        """
+
+        path = self._path(key)
+        try:
+            if set(name + '.npy' for name in arrays) <= set(os.listdir(path)):
+                os.utime(path)
+                return True
+            shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+        # Array data plus .npy headers
+        size = sum(np.asarray(array).nbytes + 128 for array in arrays.values())
+        if size > self.max_bytes:
+            return False
+        # Write into a temporary directory first so that readers never see partial entries
+        tmp = tempfile.mkdtemp(dir=self.directory, prefix='.tmp')
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), np.asarray(array))
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # Stored concurrently by another process
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict(keep=key)
+        return True
+
+    def entries(self):
+        """
+        Return a list of (last access time, size in bytes, key) for all entries
+
+        """
+
+        out = []
+        for key in os.listdir(self.directory):
+            path = self._path(key)
+            if key.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                out.append((os.path.getmtime(path), size, key))
+            except OSError:
+                # Removed concurrently by another process
+                continue
+        return out
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries (other than the entry keep) until the total size is within
+        the bound
+
+        """
+
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._path(key), ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        for _, _, key in self.entries():
+            shutil.rmtree(self._path(key), ignore_errors=True)
+
+
+def cached_run(cache, structure_file, lambdas_file, X):
+    """
+    Run the batch waterfall for a scenario set, serving the result from the cache when available.
+    The lambda dictionary is validated against the batch engine on every call (a ValueError is raised
+    if it differs). Returns a WaterfallResult (with memory-mapped arrays on a cache hit)
+
+    """
+
+    F, F_help = load_lambdas(lambdas_file)
+    check_lambdas(F)
+    key = ResultCache.key(structure_file, lambdas_file, X)
+    arrays = cache.get(key, WaterfallResult.fields)
+    if arrays is None:
+        R = run_waterfall_batch(load_structure(structure_file), X, F)
+        if not cache.put(key, {field: getattr(R, field) for field in WaterfallResult.fields}):
+            # Larger than the cache bound (not stored)
+            return R
+        arrays = cache.get(key, WaterfallResult.fields)
+        if arrays is None:
+            # Evicted concurrently by another process
+            return R
+    R = WaterfallResult.__new__(WaterfallResult)
+    for field in WaterfallResult.fields:
+        setattr(R, field, arrays[field])
+    return R
@@ -47,6 +47,7 @@ class Structure:
         self.senior_fees = 0.0025
         # Dynamic fields
         self.adj_notional = None
+        self.cure_status = None
 
     def calculate_equity(self, initial_notional):
         """
@@ -66,7 +67,7 @@ class Structure:
         Initialize all dynamic cashflow arrays to zero (placeholders)
         - actual bond / equity payments
         - scheduled bond payments
-        - collateralisation test indicators etc
+        - collateralisation test indicators etc (stored compactly as uint8)
         """
 
         self.Equity.payment = np.zeros(N)
@@ -80,10 +81,13 @@ class Structure:
         for i in range(self.Tests):
             OCTest = self.OC_Tests[i]
             OCTest.OC_Ratio = np.zeros(N)
-            OCTest.OC_Status = np.zeros(N)
+            OCTest.OC_Status = np.zeros(N, dtype=np.uint8)
             ICTest = self.IC_Tests[i]
             ICTest.IC_Ratio = np.zeros(N)
-            ICTest.IC_Status = np.zeros(N)
+            ICTest.IC_Status = np.zeros(N, dtype=np.uint8)
+        # Whether a failing OC/IC test has been cured in the period
+        self.cure_status = np.zeros((self.Tests, N), dtype=np.uint8)
+        self.reserve.balance = np.zeros(N)
 
 
 class Liability:
@@ -123,6 +127,8 @@ class Equity(Liability):
 class Reserve(Liability):
     def __init__(self):
         self.amount = 0.0
+        # Reserve account balance at the end of each period
+        self.balance = None
 
 
 #
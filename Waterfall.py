@@ -0,0 +1,821 @@
+# -*- coding: utf-8 -*-
+
+# (c) 2019 - 2024 Open Risk, all rights reserved
+#
+# openSecuritisation is licensed under the Apache 2.0 license a copy of which is included
+# in the source distribution of TransitionMatrix. This is notwithstanding any licenses of
+# third-party software included in this distribution. You may not use this file except in
+# compliance with the License.
+#
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" This module provides the waterfall execution engines
+
+* run_waterfall_ is the reference (scalar) waterfall, executing one asset scenario period by period
+* run_waterfall_batch_ evaluates the same waterfall for a whole AssetScenarioSet at once
+* WaterfallResult_ holds the resulting cashflow arrays (one row per scenario)
+* WaterfallState_ is a snapshot of an execution at a given period, from which it can be resumed
+* maturity_repayment_ applies the final period repayment to the bonds outstanding before maturity
+
+Any other execution mode must reproduce run_waterfall exactly (see fuzz_waterfall.py)
+
+"""
+
+import pickle
+
+import numpy as np
+from ruamel.yaml import YAML
+
+
+def load_structure(filename='outstructure.yml'):
+    """
+    Load a serialized securitisation structure from a YAML file
+
+    """
+
+    in_yaml = YAML(typ='unsafe')
+    inFile = open(filename, 'r')
+    S = in_yaml.load(inFile)
+    inFile.close()
+    return S
+
+
+def load_lambdas(filename='lambda_dictionary.yml'):
+    """
+    Load the stored lambda functions from a YAML file and create function objects (and help strings)
+
+    """
+
+    lambdas_yaml = YAML(typ='unsafe')
+    Lambdas_File = open(filename, 'r')
+    Lambda_Dict = lambdas_yaml.load(Lambdas_File)
+    Lambdas_File.close()
+
+    F = {}
+    F_help = {}
+    for l in Lambda_Dict:
+        F[l] = eval(Lambda_Dict[l]['function'])
+        # Keep the specification of each function so that other execution modes can validate it
+        F[l].source = Lambda_Dict[l]['function']
+        F_help[l] = Lambda_Dict[l]['description']
+    return F, F_help
+
+
+# The cashflow operations implemented natively by the vectorized engine (run_waterfall_batch), as
+# specified in lambda_dictionary.yml (whitespace is ignored in the comparison)
+BATCH_LAMBDAS = {
+    'floating_rate_payment': 'lambda x1, x2, x3: (x1 + x2) * x3',
+    'subtract_amount': 'lambda x1, x2: max(0.0, x1 - x2)',
+    'collect_payments': 'lambda x1, x2: x1 + x2',
+    'apply_scheduled_payment': 'lambda x1, x2: min(x1, x2)',
+    'compound_and_add': 'lambda x1, x2, x3: (1.0 + x1) * x2 + x3',
+    'required_reduction': 'lambda x1, x2,: max(min(x1, x2), 0.0)',
+}
+
+
+def check_lambdas(F):
+    """
+    Verify that the lambda functions F (as returned by load_lambdas) are the cashflow operations
+    implemented by the vectorized engine, raising a ValueError otherwise
+
+    """
+
+    for name, expected in BATCH_LAMBDAS.items():
+        if name not in F:
+            raise ValueError('Lambda function ' + name + ' is missing')
+        source = getattr(F[name], 'source', None)
+        if source is None or ''.join(source.split()) != ''.join(expected.split()):
+            raise ValueError('Lambda function ' + name + ' differs from the operation implemented by the '
+                             'batch engine (' + expected + '), use run_waterfall')
+
+
+def run_waterfall(S, A, F, verbose=False):
+    """
+    Reference waterfall execution for a single asset scenario
+
+    The dynamic arrays of the structure S are initialized and filled in place (bond payments and notionals,
+    equity payments, test ratios / statuses, reserve account balance) and S is returned. The static fields,
+    including the initial reserve amount, are not modified, so repeated calls give the same result.
+    With verbose=True the period by period cashflow log is printed.
+
+    """
+
+    out = print if verbose else (lambda *args: None)
+
+    # Define some aliases for conciseness
+    # Number of periods (including final repayment period)
+    N = A.periods
+    # Number of issued bonds
+    M = len(S.Liabilities)
+    # Number of OC/IC test pairs
+    T = S.Tests
+
+    # Initialize all dynamic cashflow arrays to zero (placeholders)
+    S.initialize(N)
+
+    # Auxiliary arrays (temporary within period)
+    # Required notional reduction (OC) per Trigger and Bond (current period)
+    # Required payment reduction (IC) per Trigger and Bond (current period)
+    Bond_Reduction = np.zeros((T, M))
+    Payment_Reduction = np.zeros((T, M))
+    # Running reserve account amount (the end of period balances are recorded in S.reserve.balance)
+    reserve_amount = S.reserve.amount
+
+    # For all periods before final distributions
+    for k in range(N):
+
+        # Regular period cashflows
+        if k < N - 1:
+
+            out("=-" * 40)
+            out("Period ", k)
+            out("=-" * 40)
+
+            # update scheduled payments for all bonds
+            out("Principal and Scheduled Bond Payments")
+            out("." * 80)
+            for i in range(M):
+                B = S.Liabilities[i]
+                B.Payment[k] = 0.0
+                if k == 0:
+                    B.Notional[0] = B.initial_Notional
+                else:
+                    B.Notional[k] = B.Notional[k - 1]
+
+                # B.Scheduled_Payment[k] = (A.r + B.Bond_Spread) * B.Notional[k]
+                B.Scheduled_Payment[k] = F["floating_rate_payment"](A.r, B.Bond_Spread, B.Notional[k])
+                out('Bond ', B.Indicator, B.Notional[k], B.Scheduled_Payment[k])
+            out("." * 80)
+
+            # ------------------------------------------------
+            # STAGE 1: Senior Waterfall
+            # ------------------------------------------------
+
+            # available interest proceeds (subtract fees from available) and principal proceeds
+            # interest_proceeds = max(0.0, A.interest_proceeds[k] - S.senior_fees)
+            interest_proceeds = F["subtract_amount"](A.interest_proceeds[k], S.senior_fees)
+            principal_proceeds = A.principal_proceeds[k]
+            out('Senior Waterfall')
+            out('Interest Proceeds : ', interest_proceeds)
+            out('Principal Proceeds : ', principal_proceeds)
+
+            # Simplifying assumption that there is only one Senior Bond receiving payments as per
+            # the senior waterfall segment
+            for i in range(M):
+                B = S.Liabilities[i]
+                if B.Type == 'Senior':
+                    # Calculate Actual Payment on the basis of available cashflow
+                    # Any Payment Shortfall Deferred
+                    # Adjustment to interest and principal proceeds
+                    actual_payment1 = min(B.Scheduled_Payment[k], interest_proceeds)
+                    actual_payment2 = min(B.Scheduled_Payment[k] - actual_payment1, principal_proceeds)
+                    # B.Payment[k] += actual_payment1 + actual_payment2
+                    B.Payment[k] += F["collect_payments"](actual_payment1, actual_payment2)
+                    B.Notional[k] += B.Scheduled_Payment[k] - B.Payment[k]
+                    # principal_proceeds = max(0.0, principal_proceeds - actual_payment2)
+                    principal_proceeds = F["subtract_amount"](principal_proceeds, actual_payment2)
+                    # interest_proceeds = max(0.0, interest_proceeds - actual_payment1)
+                    interest_proceeds = F["subtract_amount"](interest_proceeds, actual_payment1)
+                    out("Senior Bond Payment: ", B.Payment[k])
+                    out("Senior Notional: ", B.Notional[k])
+                    out("." * 80)
+                    out('Residual Interest Proceeds : ', interest_proceeds)
+                    out('Residual Principal Proceeds : ', principal_proceeds)
+                    out("-" * 80)
+
+            # ------------------------------------------------
+            # STAGE 2: Mezzanine Waterfall
+            # -----------------------------------------------
+
+            # Loop over all OC/IC tests starting from the most senior
+            for i in range(T):
+
+                out('Mezzanine Waterfall')
+                out('OC/IC Test : ', i)
+
+                # Step 2a: OC/IC Ratios/Tests and OC/IC Cure Calculations
+                # for the i-th OC/IC pair and for Period k
+                #
+                # Here we make the assumption that there is one OC/IC test for each Bond
+
+                OCTest = S.OC_Tests[i]
+                ICTest = S.IC_Tests[i]
+
+                # For each bond
+                # Loop over more junior bonds and calculate overcollateralization tests for this period
+                running_oc = 0.0
+                running_ic = 0.0
+                for j in range(i + 1):
+                    B = S.Liabilities[j]
+                    running_oc += B.Notional[k]
+                    running_ic += B.Scheduled_Payment[k]
+                    # Use adjusted notional
+                    S.adj_notional[k] = S.OC_haircut * A.notional[k] + principal_proceeds + reserve_amount
+                    # Calculate OC/IC Ratios
+                    OCTest.OC_Ratio[k] = S.adj_notional[k] / running_oc
+                    ICTest.IC_Ratio[k] = (interest_proceeds - S.IC_haircut) / running_ic
+
+                out('OC Ratio vs Trigger : ', OCTest.OC_Ratio[k], OCTest.OC_Trigger)
+                out('IC Ratio vs Trigger : ', ICTest.IC_Ratio[k], ICTest.IC_Trigger)
+
+                # STEP 2b: Check OC/IC Pass/Fail of Tests
+
+                OCTest.OC_Status[k] = (OCTest.OC_Ratio[k] > OCTest.OC_Trigger)
+                ICTest.IC_Status[k] = (ICTest.IC_Ratio[k] > ICTest.IC_Trigger)
+
+                out('OC Status : ', OCTest.OC_Status[k])
+                out('IC Status : ', ICTest.IC_Status[k])
+
+                # STEP 2c: IP/PP distributions on the basis of the OC/IC tests
+                # Case 2c_1: Passing the i-th (OC, IC) test
+                if OCTest.OC_Status[k] == 1 and ICTest.IC_Status[k] == 1:
+
+                    # Passing Mezzanine Test
+                    if i < T - 1:
+                        # Pay available interest in i+1 subordinated note.
+                        # If there is shortfall, it is added as deferred interest to the bond notional
+                        # Adjust interest proceeds
+                        # No changes to the available principal proceeds
+                        B = S.Liabilities[i + 1]
+                        # B.Payment[k] += min(B.Scheduled_Payment[k], interest_proceeds)
+                        B.Payment[k] += F["apply_scheduled_payment"](B.Scheduled_Payment[k], interest_proceeds)
+                        B.Notional[k] += B.Scheduled_Payment[k] - B.Payment[k]
+                        interest_proceeds = max(0.0, interest_proceeds - B.Payment[k])
+                        out('Passing Mezzanine Test Cashflows')
+                        out(B.Indicator, "Bond Payment: ", B.Payment[k])
+                        out(B.Indicator, "Bond Notional: ", B.Notional[k])
+                    # Passing Junior Test
+                    else:
+                        # Allocation of all proceeds to reserve account (if any)
+                        # Make equity payments
+                        # reserve_amount = (1.0 + A.r) * reserve_amount + principal_proceeds
+                        reserve_amount = F["compound_and_add"](A.r, reserve_amount, principal_proceeds)
+                        principal_proceeds = 0
+                        S.Equity.payment[k] = interest_proceeds
+                        interest_proceeds = 0
+                        out('Passing Junior Test Cashflows')
+                        out("Equity Payment: ", S.Equity.payment[k])
+
+                    out("." * 80)
+                    out('Residual Interest Proceeds : ', interest_proceeds)
+                    out('Residual Principal Proceeds : ', principal_proceeds)
+                    out("-" * 80)
+                # Case 2c_2: Failing the i-th test (either OC or IC or both)
+                else:
+
+                    # Entering Mandatory CURE branch
+                    # Calculate Required Notional Reduction on the Basis of OC Tests
+                    # TargetNotional is the target notional for bonds senior or equal to the failing OC/IC test
+                    TargetNotional = S.adj_notional[k] / OCTest.OC_Trigger
+                    # ActualNotional is the actual current notional for the bonds senior or equal to the OC/IC test
+                    ActualNotional = 0.0
+                    for j in range(i + 1):
+                        B = S.Liabilities[j]
+                        ActualNotional += B.Notional[k]
+
+                    # Required Senior Bond OC Test Reduction is calculated first
+                    B = S.Liabilities[0]
+                    # Bond_Reduction[i, 0] = max(min(ActualNotional - TargetNotional, B.Notional[k]), 0.0)
+                    Bond_Reduction[i, 0] = F["required_reduction"](ActualNotional - TargetNotional, B.Notional[k])
+                    cumulative_reduction = Bond_Reduction[i, 0]
+                    # For all tranches <= to the OC test, except Senior most bond
+                    for j in range(1, i + 1):
+                        B = S.Liabilities[j]
+                        Bond_Reduction[i, j] = max(
+                            min(ActualNotional - TargetNotional - cumulative_reduction, B.Notional[k]), 0.0)
+                        cumulative_reduction += Bond_Reduction[i, j]
+
+                    # Calculate Required Payment Reduction on the Basis of IC Tests
+                    # This is the target required payment for bonds senior or equal to the OC/IC test
+                    TargetPayment = (interest_proceeds - S.IC_haircut) / ICTest.IC_Trigger
+                    # This is the actual scheduled payment for the bonds senior or equal to the OC/IC test
+                    ActualPayment = 0.0
+                    for j in range(0, i):
+                        B = S.Liabilities[j]
+                        ActualPayment += B.Scheduled_Payment[k]
+
+                    # Required Senior Most Bond Reduction is calculated first
+                    B = S.Liabilities[0]
+                    Payment_Reduction[i, 0] = max(min(ActualPayment - TargetPayment, B.Scheduled_Payment[k]), 0.0)
+                    cumulative_reduction = Payment_Reduction[i, 0]
+
+                    for j in range(1, i + 1):  # For all tranches <= to the IC test, except 0-bond
+                        B = S.Liabilities[j]
+                        Payment_Reduction[i, j] = max(
+                            min(ActualPayment - TargetPayment - cumulative_reduction, B.Scheduled_Payment[k]), 0.0)
+                        cumulative_reduction += Payment_Reduction[i, j]
+
+                    # Calculate Required Notional Reduction from Required Payment Reduction
+                    # Then apply maximum required reduction per bond/test
+                    # For all bonds
+                    for j in range(M):
+                        B = S.Liabilities[j]
+                        P_Bond_Reduction = Payment_Reduction[i, j] / (A.r + B.Bond_Spread)
+                        Bond_Reduction[i, j] = max(P_Bond_Reduction, Bond_Reduction[i, j])
+
+                    # Use available interest income to repay principal of notes sequentially
+                    # up to the required reduction
+                    for j in range(i + 1):
+                        B = S.Liabilities[j]
+                        notional_reduction1 = min(Bond_Reduction[i, j], interest_proceeds)
+                        B.Notional[k] = B.Notional[k] - notional_reduction1
+                        B.Payment[k] = B.Payment[k] + notional_reduction1
+                        Bond_Reduction[i, j] = max(0.0, Bond_Reduction[i, j] - notional_reduction1)
+                        interest_proceeds = max(0.0, interest_proceeds - notional_reduction1)
+
+                        # Use available principal income to repay principal of notes sequentially
+                        # up to the required reduction
+                        notional_reduction2 = min(Bond_Reduction[i, j], principal_proceeds)
+                        B.Notional[k] = B.Notional[k] - notional_reduction2
+                        B.Payment[k] = B.Payment[k] + notional_reduction2
+                        Bond_Reduction[i, j] = max(0.0, Bond_Reduction[i, j] - notional_reduction2)
+                        principal_proceeds = max(0.0, principal_proceeds - notional_reduction2)
+
+                    # Calculate whether i-th OC/IC cure was successful
+                    # If bond reductions are complete checksum = 0
+                    checksum = 0
+                    for j in range(i + 1):
+                        checksum += Bond_Reduction[i, j]
+
+                    if checksum > 0:
+                        # Case 2c_2_Fail: CURE failed, there should be no more funds
+                        S.cure_status[i, k] = 0
+                        if i < T - 1:
+                            # Mezzanine Test Failed
+                            # Defer interest on current and more junior notes
+                            for j in range(i + 1, M):
+                                B = S.Liabilities[j]
+                                B.Notional[k] = B.Notional[k] + B.Scheduled_Payment[k]
+                                out('Failed Test / Failed Cure Mezzanine Test Cashflows')
+                                out(B.Indicator, "Bond Payment: ", B.Payment[k])
+                                out(B.Indicator, "Bond Notional: ", B.Notional[k])
+
+                        else:
+                            # Junior Test Failed
+                            # No equity payment this period
+                            reserve_amount = (1.0 + A.r) * reserve_amount + principal_proceeds
+                            principal_proceeds = 0
+                            S.Equity.payment[k] = 0
+                            out('Failed Test / Failed Cure Junior Test Cashflows')
+                            out("Equity Payment: ", S.Equity.payment[k])
+
+                    else:
+                        # Case 2c_2_Sucess: CURE succeeded, here may be some funds left for disbursement
+                        S.cure_status[i, k] = 1
+                        if i < T - 1:
+                            # Mezzanine Test Cured
+                            # Pay available interest in i+1-th subordinated note.
+                            # If there is shortfall, it is added as deferred interest to the bond notional
+                            # Adjust interest proceeds
+                            # No changes to the available principal proceeds
+                            B = S.Liabilities[i + 1]
+                            B.Payment[k] = B.Payment[k] + min(B.Scheduled_Payment[k], interest_proceeds)
+                            B.Notional[k] = B.Notional[k] + B.Scheduled_Payment[k] - B.Payment[k]
+                            interest_proceeds = max(0.0, interest_proceeds - B.Payment[k])
+                            out('Failed Test / Successful Cure Mezzanine Test Cashflows')
+                            out(B.Indicator, "Bond Payment: ", B.Payment[k])
+                            out(B.Indicator, "Bond Notional: ", B.Notional[k])
+                        else:
+                            # Junior Test Cured
+                            # Allocation of all principal proceeds to reserve account (if any)
+                            # Make equity payments this period
+                            reserve_amount = (1.0 + A.r) * reserve_amount + principal_proceeds
+                            principal_proceeds = 0
+                            S.Equity.payment[k] = interest_proceeds
+                            interest_proceeds = 0
+                            out('Failed Test / Successful Cure Junior Test Cashflows')
+                            out("Equity Payment: ", S.Equity.payment[k])
+
+                    # OC_Cure IF bracket
+                    # OC_Test IF bracket
+                    out("." * 80)
+                    out('Residual Interest Proceeds : ', interest_proceeds)
+                    out('Residual Principal Proceeds : ', principal_proceeds)
+                    out("-" * 80)
+
+            # Update Scheduled Payments for all Bonds (to take into account notional changes)
+            for j in range(M):
+                B = S.Liabilities[j]
+                B.Scheduled_Payment[k] = (A.r + B.Bond_Spread) * B.Notional[k]
+
+        # Final period cashflows: Calculate final repayments to bonds and equity
+        elif k == N - 1:
+            # Assumption: Performing collateral is sold at par and cash added to reserve account
+            # Reserve account collects last period recovery and interest proceeds
+            reserve_amount = (1.0 + A.r) * reserve_amount + \
+                A.notional[k] + A.principal_proceeds[k] + A.interest_proceeds[k]
+
+            # Sequential repayment of all bonds
+            for B in S.Liabilities:
+                B.Scheduled_Payment[k] = (1.0 + A.r + B.Bond_Spread) * B.Notional[k]
+                actual_payment = min(B.Scheduled_Payment[k], reserve_amount)
+                B.Payment[k] = B.Payment[k] + actual_payment
+                reserve_amount = max(0.0, reserve_amount - actual_payment)
+
+            # Residual cash goes to equity
+            S.Equity.payment[k] = reserve_amount
+        # Record the end of period reserve account balance
+        S.reserve.balance[k] = reserve_amount
+
+    return S
+
+
+class WaterfallResult(object):
+    def __init__(self, n_scenarios, M, T, N, dtype=np.float64):
+        """ The WaterfallResult object holds the cashflow cubes produced by a waterfall execution,
+        indexed by (scenario, bond or test, period). Cashflows and ratios are stored with the given
+        float dtype, test and cure indicators as uint8.
+
+        """
+
+        # Bond cashflows
+        self.payment = np.zeros((n_scenarios, M, N), dtype=dtype)
+        self.notional = np.zeros((n_scenarios, M, N), dtype=dtype)
+        self.scheduled_payment = np.zeros((n_scenarios, M, N), dtype=dtype)
+        # Equity cashflows
+        self.equity = np.zeros((n_scenarios, N), dtype=dtype)
+        # Reserve account balance at the end of each period
+        self.reserve = np.zeros((n_scenarios, N), dtype=dtype)
+        # Collateralisation test ratios and indicators
+        self.oc_ratio = np.zeros((n_scenarios, T, N), dtype=dtype)
+        self.ic_ratio = np.zeros((n_scenarios, T, N), dtype=dtype)
+        self.oc_status = np.zeros((n_scenarios, T, N), dtype=np.uint8)
+        self.ic_status = np.zeros((n_scenarios, T, N), dtype=np.uint8)
+        # Whether a failing test has been cured
+        self.cure_status = np.zeros((n_scenarios, T, N), dtype=np.uint8)
+
+    # Arrays compared when validating an execution mode against the reference
+    fields = ['payment', 'notional', 'scheduled_payment', 'equity', 'reserve',
+              'oc_ratio', 'ic_ratio', 'oc_status', 'ic_status', 'cure_status']
+    # Indicator arrays (bit packed when saved)
+    flags = ['oc_status', 'ic_status', 'cure_status']
+
+    @classmethod
+    def from_structure(cls, S):
+        """
+        Collect the dynamic arrays of a structure after a reference run (a single scenario)
+
+        """
+
+        M = len(S.Liabilities)
+        T = S.Tests
+        N = len(S.Equity.payment)
+        R = cls(1, M, T, N)
+        for j, B in enumerate(S.Liabilities):
+            R.payment[0, j] = B.Payment
+            R.notional[0, j] = B.Notional
+            R.scheduled_payment[0, j] = B.Scheduled_Payment
+        R.equity[0] = S.Equity.payment
+        R.reserve[0] = S.reserve.balance
+        for i in range(T):
+            R.oc_ratio[0, i] = S.OC_Tests[i].OC_Ratio
+            R.oc_status[0, i] = S.OC_Tests[i].OC_Status
+            R.ic_ratio[0, i] = S.IC_Tests[i].IC_Ratio
+            R.ic_status[0, i] = S.IC_Tests[i].IC_Status
+        R.cure_status[0] = S.cure_status
+        return R
+
+    @classmethod
+    def stack(cls, results):
+        """
+        Concatenate a list of results along the scenario axis
+
+        """
+
+        R = cls.__new__(cls)
+        for field in cls.fields:
+            setattr(R, field, np.concatenate([getattr(r, field) for r in results]))
+        return R
+
+    def save(self, file):
+        """
+        Save all arrays in their own dtype to a .npz file, with the indicator arrays bit packed
+        along the period axis
+
+        """
+
+        arrays = {}
+        for field in self.fields:
+            array = getattr(self, field)
+            if field in self.flags:
+                arrays[field + '_periods'] = np.array(array.shape[-1])
+                array = np.packbits(array, axis=-1)
+            arrays[field] = array
+        np.savez(file, **arrays)
+
+    @classmethod
+    def load(cls, file):
+        R = cls.__new__(cls)
+        with np.load(file) as data:
+            for field in cls.fields:
+                array = data[field]
+                if field in cls.flags:
+                    array = np.unpackbits(array, axis=-1, count=int(data[field + '_periods']))
+                setattr(R, field, array)
+        return R
+
+
+def maturity_repayment(S, R, r):
+    """
+    Calculate the repayment at maturity of the bonds outstanding at the end of the last regular period,
+    for all scenarios of a WaterfallResult R with risk free rates r (one per scenario)
+
+    Both engines compute the final period bond claims from the (unset) final period notional, so that all
+    final period cash goes to equity. Here the final period formula of run_waterfall is applied to the
+    notional of period N-2 instead: the claim of each bond is (1 + r + spread) * notional, paid
+    sequentially out of all final period cash. The claim is settled coupon first, so that a shortfall
+    writes down the notional (at most the initial notional of the bond: unpaid deferred interest
+    capitalized into the notional is not a loss of principal, and never negative).
+
+    Returns the payments and the principal written down, both of shape (scenarios, bonds)
+
+    """
+
+    N = R.equity.shape[-1]
+    notional = R.notional[:, :, N - 2].astype(np.float64)
+    cash = R.equity[:, N - 1].astype(np.float64) + R.payment[:, :, N - 1].sum(axis=1)
+    r = np.asarray(r, dtype=np.float64)
+    payment = np.zeros(notional.shape)
+    writedown = np.zeros(notional.shape)
+    for j, B in enumerate(S.Liabilities):
+        claim = (1.0 + r + B.Bond_Spread) * notional[:, j]
+        payment[:, j] = np.minimum(claim, cash)
+        cash = np.maximum(0.0, cash - payment[:, j])
+        writedown[:, j] = np.clip(np.minimum(claim - payment[:, j], notional[:, j]), 0.0, B.initial_Notional)
+    return payment, writedown
+
+
+class WaterfallState(object):
+    def __init__(self, R, k):
+        """ The WaterfallState object is a snapshot of a waterfall execution at the end of period k:
+        the bond notionals (including any deferred interest capitalized into them), payments and test
+        results, the equity payments so far and the reserve account balance, for all scenarios of R.
+
+        Resuming from the snapshot (see run_waterfall_batch) only requires the asset cashflows of the
+        periods k+1..N-1, so that a live deal can be rolled forward one servicer period at a time and
+        conditional forward scenarios can branch off a common history.
+
+        """
+
+        if not 0 <= k < R.equity.shape[-1] - 1:
+            raise ValueError('A snapshot must be taken before the final period')
+        # The last period included in the snapshot
+        self.period = k
+        for field in WaterfallResult.fields:
+            setattr(self, field, getattr(R, field)[..., :k + 1].copy())
+
+    @property
+    def scenarios(self):
+        return self.equity.shape[0]
+
+    @property
+    def reserve_amount(self):
+        """ The reserve account balance at the end of the snapshot period (per scenario) """
+        return self.reserve[:, -1]
+
+    def branch(self, s):
+        """
+        Extract the snapshot of the s-th scenario, to be shared by all scenarios resumed from it
+
+        """
+
+        state = WaterfallState.__new__(WaterfallState)
+        state.period = self.period
+        for field in WaterfallResult.fields:
+            setattr(state, field, getattr(self, field)[s:s + 1].copy())
+        return state
+
+    def save(self, file):
+        output = open(file, 'wb')
+        # Pickle the object using the highest protocol available.
+        pickle.dump(self, output, -1)
+        output.close()
+
+
+def run_waterfall_batch(S, X, F, state=None, stop=None, dtype=None):
+    """
+    Vectorized waterfall execution for all scenarios of an AssetScenarioSet X
+
+    The cashflow logic is identical to run_waterfall (including the order of floating point operations),
+    with each branch evaluated for all scenarios and applied where its condition holds. The lambda
+    functions F are implemented natively and are validated against that implementation (check_lambdas).
+    The structure S is only read. Returns a WaterfallResult.
+
+    If a WaterfallState is given, the periods up to and including state.period are copied from the
+    snapshot and the execution resumes with the next period (the asset cashflows of X for those earlier
+    periods are ignored). A snapshot of a single scenario is shared by all scenarios of X. If stop is
+    given only the periods before stop are executed.
+
+    The calculation of each period is carried out in float64. The result cubes are stored with the
+    given float dtype (by default the dtype of the scenario data), so that float32 only affects the
+    stored values (see README for the accuracy bounds).
+
+    """
+
+    check_lambdas(F)
+
+    N = X.periods
+    M = len(S.Liabilities)
+    T = S.Tests
+    if dtype is None:
+        dtype = X.principal_proceeds.dtype
+    R = WaterfallResult(X.scenarios, M, T, N, dtype=dtype)
+    start = 0
+    reserve = np.full(X.scenarios, float(S.reserve.amount))
+    Nt_prev = None
+    if state is not None:
+        if state.scenarios not in (1, X.scenarios):
+            raise ValueError('The snapshot holds ' + str(state.scenarios) + ' scenarios, expected 1 or '
+                             + str(X.scenarios) + ' (the scenarios of X)')
+        if state.notional.shape[1] != M or state.oc_ratio.shape[1] != T:
+            raise ValueError('The snapshot has ' + str(state.notional.shape[1]) + ' bonds and '
+                             + str(state.oc_ratio.shape[1]) + ' tests, the structure ' + str(M) + ' bonds and '
+                             + str(T) + ' tests')
+        if state.period >= N - 1:
+            raise ValueError('The snapshot period ' + str(state.period) + ' is not before the final period '
+                             + str(N - 1) + ' of X')
+        start = state.period + 1
+        for field in WaterfallResult.fields:
+            getattr(R, field)[..., :start] = getattr(state, field)
+        reserve[:] = state.reserve_amount
+        Nt_prev = R.notional[:, :, start - 1].astype(np.float64)
+
+    r = X.r.astype(np.float64)
+    spread = [B.Bond_Spread for B in S.Liabilities]
+    senior = [B.Type == 'Senior' for B in S.Liabilities]
+    zero = np.zeros(X.scenarios)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for k in range(start, N if stop is None else min(stop, N)):
+
+            # Working arrays of the current period (bond payments, notionals and scheduled payments)
+            P_k = np.zeros((X.scenarios, M))
+            Nt_k = np.zeros((X.scenarios, M))
+            Sch_k = np.zeros((X.scenarios, M))
+            equity_k = np.zeros(X.scenarios)
+            asset_notional = X.notional[:, k].astype(np.float64)
+            asset_principal = X.principal_proceeds[:, k].astype(np.float64)
+            asset_interest = X.interest_proceeds[:, k].astype(np.float64)
+
+            # Regular period cashflows
+            if k < N - 1:
+
+                for j in range(M):
+                    if k == 0:
+                        Nt_k[:, j] = S.Liabilities[j].initial_Notional
+                    else:
+                        Nt_k[:, j] = Nt_prev[:, j]
+                    Sch_k[:, j] = (r + spread[j]) * Nt_k[:, j]
+
+                # STAGE 1: Senior Waterfall
+                interest_proceeds = np.maximum(0.0, asset_interest - S.senior_fees)
+                principal_proceeds = asset_principal
+                for j in range(M):
+                    if senior[j]:
+                        actual_payment1 = np.minimum(Sch_k[:, j], interest_proceeds)
+                        actual_payment2 = np.minimum(Sch_k[:, j] - actual_payment1, principal_proceeds)
+                        P_k[:, j] += actual_payment1 + actual_payment2
+                        Nt_k[:, j] += Sch_k[:, j] - P_k[:, j]
+                        principal_proceeds = np.maximum(0.0, principal_proceeds - actual_payment2)
+                        interest_proceeds = np.maximum(0.0, interest_proceeds - actual_payment1)
+
+                # STAGE 2: Mezzanine Waterfall
+                for i in range(T):
+                    OCTest = S.OC_Tests[i]
+                    ICTest = S.IC_Tests[i]
+
+                    # Step 2a: OC/IC Ratios
+                    running_oc = 0.0
+                    running_ic = 0.0
+                    for j in range(i + 1):
+                        running_oc = running_oc + Nt_k[:, j]
+                        running_ic = running_ic + Sch_k[:, j]
+                    adj_notional = S.OC_haircut * asset_notional + principal_proceeds + reserve
+                    oc_ratio = adj_notional / running_oc
+                    ic_ratio = (interest_proceeds - S.IC_haircut) / running_ic
+                    R.oc_ratio[:, i, k] = oc_ratio
+                    R.ic_ratio[:, i, k] = ic_ratio
+
+                    # STEP 2b: Check OC/IC Pass/Fail of Tests
+                    R.oc_status[:, i, k] = oc_ratio > OCTest.OC_Trigger
+                    R.ic_status[:, i, k] = ic_ratio > ICTest.IC_Trigger
+                    passing = (R.oc_status[:, i, k] == 1) & (R.ic_status[:, i, k] == 1)
+                    failing = ~passing
+
+                    # Case 2c_1: Passing the i-th (OC, IC) test
+                    if i < T - 1:
+                        b = i + 1
+                        payment = P_k[:, b] + np.minimum(Sch_k[:, b], interest_proceeds)
+                        P_k[:, b] = np.where(passing, payment, P_k[:, b])
+                        Nt_k[:, b] = np.where(passing, Nt_k[:, b] + (Sch_k[:, b] - P_k[:, b]), Nt_k[:, b])
+                        interest_proceeds = np.where(passing, np.maximum(0.0, interest_proceeds - P_k[:, b]),
+                                                     interest_proceeds)
+                    else:
+                        reserve = np.where(passing, (1.0 + r) * reserve + principal_proceeds, reserve)
+                        principal_proceeds = np.where(passing, zero, principal_proceeds)
+                        equity_k = np.where(passing, interest_proceeds, equity_k)
+                        interest_proceeds = np.where(passing, zero, interest_proceeds)
+
+                    # Case 2c_2: Failing the i-th test, mandatory CURE branch
+                    if not failing.any():
+                        continue
+
+                    # Required Notional Reduction on the Basis of OC Tests
+                    TargetNotional = adj_notional / OCTest.OC_Trigger
+                    ActualNotional = 0.0
+                    for j in range(i + 1):
+                        ActualNotional = ActualNotional + Nt_k[:, j]
+                    Bond_Reduction = []
+                    cumulative_reduction = np.maximum(np.minimum(ActualNotional - TargetNotional, Nt_k[:, 0]), 0.0)
+                    Bond_Reduction.append(cumulative_reduction)
+                    for j in range(1, i + 1):
+                        reduction = np.maximum(
+                            np.minimum(ActualNotional - TargetNotional - cumulative_reduction, Nt_k[:, j]), 0.0)
+                        Bond_Reduction.append(reduction)
+                        cumulative_reduction = cumulative_reduction + reduction
+
+                    # Required Payment Reduction on the Basis of IC Tests
+                    TargetPayment = (interest_proceeds - S.IC_haircut) / ICTest.IC_Trigger
+                    ActualPayment = 0.0
+                    for j in range(0, i):
+                        ActualPayment = ActualPayment + Sch_k[:, j]
+                    cumulative_reduction = np.maximum(np.minimum(ActualPayment - TargetPayment, Sch_k[:, 0]), 0.0)
+                    Payment_Reduction = [cumulative_reduction]
+                    for j in range(1, i + 1):
+                        reduction = np.maximum(
+                            np.minimum(ActualPayment - TargetPayment - cumulative_reduction, Sch_k[:, j]), 0.0)
+                        Payment_Reduction.append(reduction)
+                        cumulative_reduction = cumulative_reduction + reduction
+
+                    # Apply maximum required reduction per bond
+                    for j in range(i + 1):
+                        Bond_Reduction[j] = np.maximum(Payment_Reduction[j] / (r + spread[j]), Bond_Reduction[j])
+
+                    # Use available interest and principal income to repay principal of notes sequentially
+                    ip = interest_proceeds
+                    pp = principal_proceeds
+                    checksum = 0.0
+                    for j in range(i + 1):
+                        notional_reduction1 = np.minimum(Bond_Reduction[j], ip)
+                        notional = Nt_k[:, j] - notional_reduction1
+                        payment = P_k[:, j] + notional_reduction1
+                        Bond_Reduction[j] = np.maximum(0.0, Bond_Reduction[j] - notional_reduction1)
+                        ip = np.maximum(0.0, ip - notional_reduction1)
+
+                        notional_reduction2 = np.minimum(Bond_Reduction[j], pp)
+                        Nt_k[:, j] = np.where(failing, notional - notional_reduction2, Nt_k[:, j])
+                        P_k[:, j] = np.where(failing, payment + notional_reduction2, P_k[:, j])
+                        Bond_Reduction[j] = np.maximum(0.0, Bond_Reduction[j] - notional_reduction2)
+                        pp = np.maximum(0.0, pp - notional_reduction2)
+                        checksum = checksum + Bond_Reduction[j]
+                    interest_proceeds = np.where(failing, ip, interest_proceeds)
+                    principal_proceeds = np.where(failing, pp, principal_proceeds)
+
+                    cure_failed = failing & (checksum > 0)
+                    cured = failing & ~(checksum > 0)
+                    R.cure_status[:, i, k] = cured
+                    if i < T - 1:
+                        # Mezzanine Test Failed: defer interest on current and more junior notes
+                        for j in range(i + 1, M):
+                            Nt_k[:, j] = np.where(cure_failed, Nt_k[:, j] + Sch_k[:, j], Nt_k[:, j])
+                        # Mezzanine Test Cured: pay available interest in i+1-th subordinated note
+                        b = i + 1
+                        payment = P_k[:, b] + np.minimum(Sch_k[:, b], interest_proceeds)
+                        P_k[:, b] = np.where(cured, payment, P_k[:, b])
+                        Nt_k[:, b] = np.where(cured, Nt_k[:, b] + Sch_k[:, b] - P_k[:, b], Nt_k[:, b])
+                        interest_proceeds = np.where(cured, np.maximum(0.0, interest_proceeds - P_k[:, b]),
+                                                     interest_proceeds)
+                    else:
+                        # Junior Test: principal proceeds to reserve account, equity paid only if cured
+                        reserve = np.where(failing, (1.0 + r) * reserve + principal_proceeds, reserve)
+                        principal_proceeds = np.where(failing, zero, principal_proceeds)
+                        equity_k = np.where(cure_failed, zero, equity_k)
+                        equity_k = np.where(cured, interest_proceeds, equity_k)
+                        interest_proceeds = np.where(cured, zero, interest_proceeds)
+
+                # Update Scheduled Payments for all Bonds (to take into account notional changes)
+                for j in range(M):
+                    Sch_k[:, j] = (r + spread[j]) * Nt_k[:, j]
+
+            # Final period cashflows: Calculate final repayments to bonds and equity
+            else:
+                reserve = (1.0 + r) * reserve + asset_notional + asset_principal + \
+                          asset_interest
+                for j in range(M):
+                    Sch_k[:, j] = (1.0 + r + spread[j]) * Nt_k[:, j]
+                    actual_payment = np.minimum(Sch_k[:, j], reserve)
+                    P_k[:, j] = P_k[:, j] + actual_payment
+                    reserve = np.maximum(0.0, reserve - actual_payment)
+                equity_k = reserve
+
+            R.payment[:, :, k] = P_k
+            R.notional[:, :, k] = Nt_k
+            R.scheduled_payment[:, :, k] = Sch_k
+            R.equity[:, k] = equity_k
+            R.reserve[:, k] = reserve
+            Nt_prev = Nt_k
+
+    return R
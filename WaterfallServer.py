@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+
+# (c) 2019 - 2024 Open Risk, all rights reserved
+#
+# openSecuritisation is licensed under the Apache 2.0 license a copy of which is included
+# in the source distribution of TransitionMatrix. This is notwithstanding any licenses of
+# third-party software included in this distribution. You may not use this file except in
+# compliance with the License.
+#
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" This module provides a local waterfall evaluation server
+
+* WaterfallServer_ keeps deal structures and scenario sets in memory and serves waterfall runs
+* request_ is a minimal synchronous client
+
+The protocol is newline delimited JSON over a Unix socket or a localhost TCP port. Requests:
+
+- {"op": "run", "deal": name, "bumps": {...}} runs the waterfall of a deal under scenario bumps
+  ("rate": additive shift of the risk free rate, "interest" / "principal" / "notional": multipliers of
+  the asset cashflows) and returns the mean bond payments, notionals and equity payments per period
+- {"op": "deals"} lists the loaded deals
+- {"op": "metrics"} returns latency and throughput metrics
+
+Concurrent run requests are coalesced: requests for the same deal arriving within max_delay are stacked
+into a single batched waterfall evaluation. Invalid requests are answered with {"error": message} without
+affecting the other requests of a batch.
+
+Usage: python WaterfallServer.py --deal name=outstructure.yml:asset_scenario.pkl [--socket path | --port 8765]
+
+"""
+
+import argparse
+import asyncio
+import json
+import pickle
+import socket
+import time
+from collections import deque
+
+import numpy as np
+
+from AssetScenario import AssetScenarioSet
+from Waterfall import check_lambdas, load_lambdas, load_structure, run_waterfall_batch
+
+
+# Scenario bumps accepted in run requests
+BUMPS = ['rate', 'interest', 'principal', 'notional']
+
+
+def check_bumps(bumps):
+    """
+    Return an error message if a bumps value is not a dictionary of numbers with known keys, else None
+
+    """
+
+    if not isinstance(bumps, dict):
+        return 'Bumps must be an object, got ' + json.dumps(bumps)
+    for key, value in bumps.items():
+        if key not in BUMPS:
+            return 'Unknown bump ' + key + ' (expected one of ' + ', '.join(BUMPS) + ')'
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not np.isfinite(value):
+            return 'Bump ' + key + ' must be a finite number, got ' + json.dumps(value)
+    return None
+
+
+def bump_scenarios(X, bumps):
+    """
+    Return a copy of an AssetScenarioSet with the bumps applied
+
+    """
+
+    out = X.chunk(0, X.scenarios)
+    out.r = X.r + bumps.get('rate', 0.0)
+    out.interest_proceeds = X.interest_proceeds * bumps.get('interest', 1.0)
+    out.principal_proceeds = X.principal_proceeds * bumps.get('principal', 1.0)
+    out.notional = X.notional * bumps.get('notional', 1.0)
+    return out
+
+
+class Metrics(object):
+    def __init__(self, window=1000):
+        """ The Metrics object collects request latencies (over a moving window) and batch sizes """
+
+        self.start = time.monotonic()
+        self.requests = 0
+        self.batches = 0
+        self.batched_requests = 0
+        self.latency = deque(maxlen=window)
+
+    def report(self):
+        elapsed = time.monotonic() - self.start
+        latency = np.array(self.latency) * 1000.0
+        out = {
+            'requests': self.requests,
+            'batches': self.batches,
+            'mean_batch_size': self.batched_requests / self.batches if self.batches else 0.0,
+            'throughput_per_second': self.requests / elapsed if elapsed > 0 else 0.0,
+        }
+        if len(latency):
+            out['latency_ms'] = {'mean': float(latency.mean()),
+                                 'p50': float(np.percentile(latency, 50)),
+                                 'p99': float(np.percentile(latency, 99))}
+        return out
+
+
+class WaterfallServer(object):
+    def __init__(self, deals, F, max_batch=64, max_delay=0.002):
+        """ The WaterfallServer object holds the resident deals, as a dictionary from deal name to
+        (structure, AssetScenarioSet), and the lambda functions F (validated against the batch engine on
+        start up). Run requests are coalesced into batched evaluations of up to max_batch requests,
+        waiting at most max_delay seconds for a batch to fill.
+
+        """
+
+        check_lambdas(F)
+        self.deals = deals
+        self.F = F
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.metrics = Metrics()
+        self.queue = None
+
+    @classmethod
+    def load(cls, specifications, lambdas_file='lambda_dictionary.yml', **kwargs):
+        """
+        Load deals from 'name=structure.yml:scenarios.pkl' specifications and the lambda dictionary.
+        The pickled scenario data may be an AssetScenario or an AssetScenarioSet
+
+        """
+
+        deals = {}
+        for specification in specifications:
+            name, files = specification.split('=', 1)
+            structure_file, scenario_file = files.split(':', 1)
+            X = pickle.load(open(scenario_file, 'rb'))
+            if not isinstance(X, AssetScenarioSet):
+                X = AssetScenarioSet.from_scenarios([X])
+            deals[name] = (load_structure(structure_file), X)
+        F, F_help = load_lambdas(lambdas_file)
+        return cls(deals, F, **kwargs)
+
+    def evaluate(self, name, bumps_list):
+        """
+        Run the waterfall of a deal for a list of bump dictionaries in one batch and return one
+        response per bump dictionary
+
+        """
+
+        S, X = self.deals[name]
+        X_bumped = AssetScenarioSet.concatenate([bump_scenarios(X, b) for b in bumps_list])
+        R = run_waterfall_batch(S, X_bumped, self.F)
+        n = X.scenarios
+        responses = []
+        for i in range(len(bumps_list)):
+            rows = slice(i * n, (i + 1) * n)
+            payment = R.payment[rows].mean(axis=0)
+            notional = R.notional[rows].mean(axis=0)
+            responses.append({
+                'deal': name,
+                'tranches': {B.Indicator: {'payment': payment[j].tolist(), 'notional': notional[j].tolist()}
+                             for j, B in enumerate(S.Liabilities)},
+                'equity': R.equity[rows].mean(axis=0).tolist(),
+            })
+        return responses
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            groups = {}
+            for name, bumps, future in batch:
+                groups.setdefault(name, []).append((bumps, future))
+            for name, items in groups.items():
+                try:
+                    # Run in a worker thread so that the event loop keeps accepting requests
+                    responses = await loop.run_in_executor(None, self.evaluate, name, [b for b, _ in items])
+                except Exception:
+                    # Evaluate the requests one by one so that a failing request does not fail the others
+                    responses = []
+                    for bumps, _ in items:
+                        try:
+                            responses += await loop.run_in_executor(None, self.evaluate, name, [bumps])
+                        except Exception as e:
+                            responses.append({'error': repr(e)})
+                for (_, future), response in zip(items, responses):
+                    future.set_result(response)
+                self.metrics.batches += 1
+                self.metrics.batched_requests += len(items)
+
+    async def dispatch(self, request):
+        if not isinstance(request, dict):
+            return {'error': 'Requests must be JSON objects, got ' + json.dumps(request)}
+        op = request.get('op', 'run')
+        if op == 'metrics':
+            return self.metrics.report()
+        if op == 'deals':
+            return {name: {'tranches': [B.Indicator for B in S.Liabilities], 'scenarios': X.scenarios,
+                           'periods': X.periods} for name, (S, X) in self.deals.items()}
+        if op == 'run':
+            if not isinstance(request.get('deal'), str) or request['deal'] not in self.deals:
+                return {'error': 'Unknown deal ' + str(request.get('deal'))}
+            bumps = request.get('bumps', {})
+            error = check_bumps(bumps)
+            if error:
+                return {'error': error}
+            future = asyncio.get_running_loop().create_future()
+            await self.queue.put((request['deal'], bumps, future))
+            return await future
+        return {'error': 'Unknown operation ' + str(op)}
+
+    async def handle(self, reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            start = time.monotonic()
+            try:
+                response = await self.dispatch(json.loads(line))
+            except ValueError as e:
+                response = {'error': repr(e)}
+            self.metrics.requests += 1
+            self.metrics.latency.append(time.monotonic() - start)
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+        writer.close()
+
+    async def serve(self, path=None, host='127.0.0.1', port=8765):
+        """
+        Serve on a Unix socket (if a path is given) or on a localhost TCP port until cancelled
+
+        """
+
+        self.queue = asyncio.Queue()
+        batcher = asyncio.create_task(self.batcher())
+        if path:
+            server = await asyncio.start_unix_server(self.handle, path=path)
+        else:
+            server = await asyncio.start_server(self.handle, host=host, port=port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+def request(payload, path=None, host='127.0.0.1', port=8765):
+    """
+    Send a single request to a running server and return the decoded response
+
+    """
+
+    if path:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+    else:
+        sock = socket.create_connection((host, port))
+    with sock, sock.makefile('rwb') as f:
+        f.write(json.dumps(payload).encode() + b'\n')
+        f.flush()
+        return json.loads(f.readline())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local waterfall evaluation server')
+    parser.add_argument('--deal', action='append', default=[],
+                        help='name=structure.yml:scenarios.pkl (may be repeated)')
+    parser.add_argument('--lambdas', default='lambda_dictionary.yml', help='lambda dictionary YAML file')
+    parser.add_argument('--socket', default=None, help='Unix socket path (default: localhost TCP)')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--max-delay', type=float, default=0.002, help='seconds')
+    args = parser.parse_args()
+
+    server = WaterfallServer.load(args.deal or ['default=outstructure.yml:asset_scenario.pkl'], args.lambdas,
+                                  max_batch=args.max_batch, max_delay=args.max_delay)
+    asyncio.run(server.serve(path=args.socket, port=args.port))
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+
+# (c) 2019 - 2024 Open Risk, all rights reserved
+#
+# openSecuritisation is licensed under the Apache 2.0 license a copy of which is included
+# in the source distribution of TransitionMatrix. This is notwithstanding any licenses of
+# third-party software included in this distribution. You may not use this file except in
+# compliance with the License.
+#
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Differential fuzz harness
+
+Generates random structures, triggers and default paths (biased towards OC/IC test failures, cures and
+deferred interest) and compares every registered execution mode against the reference waterfall
+(Waterfall.run_waterfall), element by element. Failing cases are shrunk to a minimal reproduction.
+
+Usage: python fuzz_waterfall.py [--runs 200] [--seed 0]
+
+"""
+
+import argparse
+
+import numpy as np
+
+from AssetScenario import AssetScenario, AssetScenarioSet
+from Securitisation import Structure, Bond, Equity, Reserve, OC_Test, IC_Test
+from Waterfall import load_lambdas, maturity_repayment, run_waterfall, run_waterfall_batch, WaterfallResult, \
+    WaterfallState
+
+###################################################
+# Execution modes under test
+#
+# Each entry maps a name to (engine, tolerance, inputs). An engine takes a structure,
+# an AssetScenarioSet and the lambda functions and returns a WaterfallResult. If inputs
+# is given, the engine and the reference both run on the scenario set inputs(X)
+###################################################
+
+
+# Documented accuracy of float32 result cubes, absolute and relative (see README)
+FLOAT32_TOLERANCE = 1e-6
+
+
+def reference_engine(S, X, F):
+    # The same structure is reused for all scenarios (run_waterfall only fills its dynamic arrays)
+    results = []
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for s in range(X.scenarios):
+            run_waterfall(S, X.scenario(s), F)
+            results.append(WaterfallResult.from_structure(S))
+    return WaterfallResult.stack(results)
+
+
+def repeat_engine(S, X, F):
+    # Repeated reference runs on the same structure must not depend on the earlier runs
+    reference_engine(S, X, F)
+    return reference_engine(S, X, F)
+
+
+def resume_engine(S, X, F):
+    # Snapshot halfway through the horizon and resume from there
+    k = X.periods // 2 - 1
+    prefix = run_waterfall_batch(S, X, F, stop=k + 1)
+    return run_waterfall_batch(S, X, F, state=WaterfallState(prefix, k))
+
+
+def branch_engine(S, X, F):
+    # Resume every scenario separately from its own single scenario snapshot
+    k = X.periods - 2
+    state = WaterfallState(run_waterfall_batch(S, X, F, stop=k + 1), k)
+    results = []
+    for s in range(X.scenarios):
+        Xs = AssetScenarioSet.from_scenarios([X.scenario(s)])
+        results.append(run_waterfall_batch(S, Xs, F, state=state.branch(s)))
+    return WaterfallResult.stack(results)
+
+
+def float32_store(X):
+    # Scenario data rounded to float32 (the float32 store) and converted back for the reference
+    return X.astype(np.float32).astype(np.float64)
+
+
+ENGINES = {
+    'batch': (run_waterfall_batch, 0.0, None),
+    'repeat': (repeat_engine, 0.0, None),
+    'resume': (resume_engine, 0.0, None),
+    'branch': (branch_engine, 0.0, None),
+    'float32': (lambda S, X, F: run_waterfall_batch(S, X, F, dtype=np.float32), FLOAT32_TOLERANCE, None),
+    # float32 scenario store (and therefore float32 result cubes)
+    'float32_store': (lambda S, X, F: run_waterfall_batch(S, X.astype(np.float32), F), FLOAT32_TOLERANCE,
+                      float32_store),
+}
+
+
+###################################################
+# Random case generation
+#
+# A case is a plain dictionary specification from which the structure and scenarios are built,
+# so that it can be shrunk and printed as a reproduction
+###################################################
+
+def random_spec(rng):
+    M = int(rng.integers(1, 6))
+    N = int(rng.integers(2, 25))
+    n_scenarios = int(rng.integers(1, 6))
+
+    # Tranche sizes (senior first) leaving a random equity piece
+    sizes = rng.dirichlet(np.ones(M + 1)) * rng.uniform(0.8, 1.0)
+    sizes[0] += 0.3
+    sizes = np.round(sizes / sizes.sum() * rng.uniform(0.85, 1.0), 3)
+    spreads = np.round(np.sort(rng.uniform(0.005, 0.2, M)), 3)
+
+    # Usually one senior bond ahead of the mezzanine bonds, otherwise none or several (anywhere)
+    if rng.random() < 0.6:
+        senior = [j == 0 for j in range(M)]
+    else:
+        senior = (rng.random(M) < 0.3).tolist()
+
+    # Usually one OC/IC test per bond, otherwise fewer tests than bonds (possibly none)
+    T = M if rng.random() < 0.6 else int(rng.integers(0, M + 1))
+
+    # Triggers are decreasing with subordination, frequently set close to the collateral coverage
+    oc_triggers = np.round(np.sort(rng.uniform(0.95, 1.4, T))[::-1], 3)
+    ic_triggers = np.round(rng.uniform(0.5, 2.0, T), 3)
+
+    # Default paths with bursts that push the OC / IC tests into failure
+    default_rates = []
+    for s in range(n_scenarios):
+        dr = np.clip(rng.normal(rng.uniform(0.0, 0.05), 0.02, N), 0.0, None)
+        bursts = rng.random(N) < 0.15
+        dr[bursts] += rng.uniform(0.05, 0.4, bursts.sum())
+        default_rates.append(np.round(np.clip(dr, 0.0, 1.0), 3).tolist())
+
+    # Risk free rate shared by all scenarios or drawn per scenario
+    if rng.random() < 0.5:
+        r = [float(rng.choice([0.0, 0.01, 0.03]))] * n_scenarios
+    else:
+        r = np.round(rng.uniform(0.0, 0.05, n_scenarios), 3).tolist()
+
+    return {
+        'notionals': sizes[:M].tolist(),
+        'spreads': spreads.tolist(),
+        'senior': senior,
+        'oc_triggers': oc_triggers.tolist(),
+        'ic_triggers': ic_triggers.tolist(),
+        'senior_fees': float(np.round(rng.choice([0.0, 0.0025, 0.01]), 4)),
+        'IC_haircut': float(rng.choice([0.0, 0.0, 0.005])),
+        'OC_haircut': float(rng.choice([1.0, 1.0, 0.9])),
+        'reserve': float(rng.choice([0.0, 0.0, 0.02])),
+        'r': r,
+        'asset_spread': float(np.round(rng.uniform(0.01, 0.15), 3)),
+        'recovery': float(np.round(rng.uniform(0.0, 0.6), 2)),
+        'default_rates': default_rates,
+    }
+
+
+def build_case(spec):
+    """
+    Build the structure and the asset scenario set described by a specification
+
+    """
+
+    S = Structure()
+    S.Liabilities = []
+    for j, (notional, spread, senior) in enumerate(zip(spec['notionals'], spec['spreads'], spec['senior'])):
+        B = Bond()
+        B.initial_Notional = notional
+        B.Bond_Spread = spread
+        B.Type = 'Senior' if senior else 'Mezzanine'
+        B.Rank = None if senior else j
+        B.Indicator = 'B' + str(j)
+        S.Liabilities.append(B)
+    S.OC_Tests = []
+    S.IC_Tests = []
+    for oc_trigger, ic_trigger in zip(spec['oc_triggers'], spec['ic_triggers']):
+        OCTest = OC_Test()
+        OCTest.OC_Trigger = oc_trigger
+        S.OC_Tests.append(OCTest)
+        ICTest = IC_Test()
+        ICTest.IC_Trigger = ic_trigger
+        S.IC_Tests.append(ICTest)
+    S.Tests = len(S.OC_Tests)
+    S.Equity = Equity()
+    S.reserve = Reserve()
+    S.reserve.amount = spec['reserve']
+    S.senior_fees = spec['senior_fees']
+    S.IC_haircut = spec['IC_haircut']
+    S.OC_haircut = spec['OC_haircut']
+    S.calculate_equity(1.0)
+
+    scenarios = []
+    for dr, r in zip(spec['default_rates'], spec['r']):
+        A = AssetScenario(len(dr))
+        A.r = r
+        A.asset_spread = spec['asset_spread']
+        A.recovery = spec['recovery']
+        A.project(dr)
+        scenarios.append(A)
+    return S, AssetScenarioSet.from_scenarios(scenarios)
+
+
+###################################################
+# Comparison and shrinking
+###################################################
+
+def compare(ref, res, tolerance=0.0):
+    """
+    Return a list of (field, index, reference value, engine value) for all mismatching elements.
+    Values match within the tolerance, both absolute and relative to the reference value
+
+    """
+
+    mismatches = []
+    for field in WaterfallResult.fields:
+        a = getattr(ref, field)
+        b = getattr(res, field)
+        if a.shape != b.shape:
+            mismatches.append((field, 'shape', a.shape, b.shape))
+            continue
+        bad = ~np.isclose(a, b, rtol=tolerance, atol=tolerance, equal_nan=True)
+        for index in zip(*np.nonzero(bad)):
+            mismatches.append((field, tuple(int(x) for x in index), a[index], b[index]))
+    return mismatches
+
+
+def check(spec, engine, tolerance, inputs, F):
+    S, X = build_case(spec)
+    if inputs is not None:
+        X = inputs(X)
+    try:
+        res = engine(S, X, F)
+    except Exception as e:
+        return [('exception', None, None, repr(e))]
+    return compare(reference_engine(S, X, F), res, tolerance)
+
+
+def check_maturity(spec, F):
+    """
+    Check Waterfall.maturity_repayment (the maturity cashflows and principal losses of Portfolio) against
+    the final period formula of run_waterfall applied to the notionals of period N-2, scenario by scenario,
+    and check that the writedowns are consistent with the payments: the shortfall of each claim writes
+    down the notional (coupon first) and a bond is only paid once all bonds before it are paid in full
+
+    """
+
+    S, X = build_case(spec)
+    payment, writedown = maturity_repayment(S, run_waterfall_batch(S, X, F), X.r)
+    mismatches = []
+    for s in range(X.scenarios):
+        A = X.scenario(s)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            run_waterfall(S, A, F)
+        N = A.periods
+        cash = S.Equity.payment[N - 1] + sum(B.Payment[N - 1] for B in S.Liabilities)
+        shortfall = False
+        for j, B in enumerate(S.Liabilities):
+            claim = (1.0 + A.r + B.Bond_Spread) * B.Notional[N - 2]
+            actual_payment = min(claim, cash)
+            cash = max(0.0, cash - actual_payment)
+            expected = max(0.0, min(claim - actual_payment, B.Notional[N - 2], B.initial_Notional))
+            if payment[s, j] != actual_payment:
+                mismatches.append(('maturity payment', (s, j), actual_payment, payment[s, j]))
+            if writedown[s, j] != expected or writedown[s, j] < 0.0:
+                mismatches.append(('writedown', (s, j), expected, writedown[s, j]))
+            if shortfall and payment[s, j] > 0.0:
+                mismatches.append(('payment after shortfall', (s, j), 0.0, payment[s, j]))
+            if writedown[s, j] > 0.0 and payment[s, j] >= claim:
+                mismatches.append(('writedown without shortfall', (s, j), payment[s, j], writedown[s, j]))
+            shortfall = shortfall or payment[s, j] < claim
+    return mismatches
+
+
+def candidates(spec):
+    """
+    Generate simpler variants of a specification (fewer scenarios, tranches, tests and periods, fewer
+    defaults, a single senior bond)
+
+    """
+
+    n_scenarios = len(spec['default_rates'])
+    if n_scenarios > 1:
+        for s in range(n_scenarios):
+            yield dict(spec, default_rates=[spec['default_rates'][s]], r=[spec['r'][s]])
+    M = len(spec['notionals'])
+    T = len(spec['oc_triggers'])
+    if M > 1:
+        # Drop the most junior bond (and its test, as there can be no more tests than bonds)
+        yield dict(spec, **{key: spec[key][:M - 1] for key in ['notionals', 'spreads', 'senior', 'oc_triggers',
+                                                               'ic_triggers']})
+    if T > 0:
+        yield dict(spec, oc_triggers=spec['oc_triggers'][:-1], ic_triggers=spec['ic_triggers'][:-1])
+    if spec['senior'] != [j == 0 for j in range(M)]:
+        yield dict(spec, senior=[j == 0 for j in range(M)])
+    N = len(spec['default_rates'][0])
+    for n in sorted({2, N // 2, N - 1}):
+        if 2 <= n < N:
+            yield dict(spec, default_rates=[dr[:n] for dr in spec['default_rates']])
+    if any(r != 0.0 for r in spec['r']):
+        yield dict(spec, r=[0.0] * n_scenarios)
+    for key, simple in [('reserve', 0.0), ('senior_fees', 0.0), ('IC_haircut', 0.0),
+                        ('OC_haircut', 1.0)]:
+        if spec[key] != simple:
+            yield dict(spec, **{key: simple})
+    for k in range(N):
+        if any(dr[k] != 0.0 for dr in spec['default_rates']):
+            yield dict(spec, default_rates=[dr[:k] + [0.0] + dr[k + 1:] for dr in spec['default_rates']])
+
+
+def shrink(spec, failing):
+    """
+    Greedily replace the failing specification by simpler variants that still fail (failing(spec) is true)
+
+    """
+
+    progress = True
+    while progress:
+        progress = False
+        for candidate in candidates(spec):
+            if failing(candidate):
+                spec = candidate
+                progress = True
+                break
+    return spec
+
+
+def fuzz(runs=200, seed=0, engines=None):
+    """
+    Run the differential fuzz test and the maturity repayment check ('maturity') and return a dictionary
+    of minimal failing specifications per engine
+
+    """
+
+    F, F_help = load_lambdas('lambda_dictionary.yml')
+    rng = np.random.default_rng(seed)
+    engines = engines or ENGINES
+    failures = {}
+    for run in range(runs):
+        spec = random_spec(rng)
+        for name, (engine, tolerance, inputs) in engines.items():
+            if name in failures:
+                continue
+            if check(spec, engine, tolerance, inputs, F):
+                failures[name] = shrink(spec, lambda c: check(c, engine, tolerance, inputs, F))
+        if 'maturity' not in failures and check_maturity(spec, F):
+            failures['maturity'] = shrink(spec, lambda c: check_maturity(c, F))
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Differential fuzz test of waterfall execution modes')
+    parser.add_argument('--runs', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    failures = fuzz(args.runs, args.seed)
+    F, F_help = load_lambdas('lambda_dictionary.yml')
+    print("=" * 80)
+    for name in list(ENGINES) + ['maturity']:
+        if name not in failures:
+            print(name, ": OK (", args.runs, "cases )")
+            continue
+        spec = failures[name]
+        print(name, ": FAILED, minimal reproduction")
+        print(spec)
+        mismatches = check_maturity(spec, F) if name == 'maturity' else check(spec, *ENGINES[name], F)
+        for mismatch in mismatches[:10]:
+            print('   ', mismatch)
+    print("=" * 80)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+# (c) 2019 - 2024 Open Risk, all rights reserved
+#
+# openSecuritisation is licensed under the Apache 2.0 license a copy of which is included
+# in the source distribution of TransitionMatrix. This is notwithstanding any licenses of
+# third-party software included in this distribution. You may not use this file except in
+# compliance with the License.
+#
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+
+Inputs:
+- Serialized Structure in YAML file
+- Stored Lambda functions in YAML file
+- A simulated set of default rate scenarios
+
+Output:
+- Quantile fan charts of bond payments, bond notionals and equity payments (cashflow_fan.png)
+
+"""
+
+import numpy as np
+
+from AssetScenario import AssetScenarioSet
+from FanChart import render_fan_charts
+from Waterfall import load_lambdas, load_structure, run_waterfall_batch
+
+###################################################
+# Simulate default rate scenarios
+###################################################
+
+n_scenarios = 100000
+periods = 20
+np.random.seed(0)
+default_rates = np.around(np.clip(np.random.normal(0.03, 0.03, (n_scenarios, periods)), 0.0, None), decimals=3)
+X = AssetScenarioSet.from_default_rates(default_rates)
+
+###################################################
+# Waterfall Execution (float32 result cubes) and fan charts
+###################################################
+
+S = load_structure('outstructure.yml')
+F, F_help = load_lambdas('lambda_dictionary.yml')
+R = run_waterfall_batch(S, X, F, dtype=np.float32)
+render_fan_charts(R, 'cashflow_fan.png', S)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+# (c) 2019 - 2024 Open Risk, all rights reserved
+#
+# openSecuritisation is licensed under the Apache 2.0 license a copy of which is included
+# in the source distribution of TransitionMatrix. This is notwithstanding any licenses of
+# third-party software included in this distribution. You may not use this file except in
+# compliance with the License.
+#
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+
+Inputs:
+- Serialized Structures in YAML files (one per deal)
+- A shared set of macro default rate scenarios
+
+Output:
+- Portfolio level principal loss distribution of the positions held
+
+"""
+
+import numpy as np
+
+from AssetScenario import AssetScenarioSet
+from Portfolio import Deal, run_portfolio
+
+###################################################
+# Shared macro scenarios
+###################################################
+
+n_scenarios = 10000
+periods = 20
+np.random.seed(0)
+systematic = np.clip(np.random.normal(0.02, 0.02, (n_scenarios, periods)), 0.0, None)
+default_rates = np.around(systematic, decimals=3)
+
+###################################################
+# Deals: structure, asset scenario stream and positions
+#
+# Each pool maps the shared default rates to its own cashflows
+###################################################
+
+deals = [
+    Deal('Deal 1', 'outstructure.yml',
+         AssetScenarioSet.from_default_rates(default_rates, asset_spread=0.10, recovery=0.30),
+         {'A1': 0.10, 'M1': 0.50}),
+    Deal('Deal 2', 'outstructure.yml',
+         AssetScenarioSet.from_default_rates(np.minimum(1.5 * default_rates, 1.0), asset_spread=0.12, recovery=0.20),
+         {'M2': 1.0, 'M3': 1.0}),
+]
+
+###################################################
+# Portfolio Execution
+###################################################
+
+if __name__ == "__main__":
+    P = run_portfolio(deals)
+
+    print("=" * 80)
+    print("Portfolio Losses")
+    print("-" * 80)
+    print("Face Amount Held: ", P.face)
+    print("Expected Loss: ", np.mean(P.loss()))
+    print("Expected Loss Rate: ", np.mean(P.loss_rate()))
+    for q, value in zip((0.5, 0.9, 0.99, 0.999), P.loss_quantiles()):
+        print("Loss Quantile ", q, ": ", value)
+    print("=" * 80)